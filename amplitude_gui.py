@@ -14,10 +14,10 @@ Saves data to file
 
 ## Imports
 import numpy as np
-import time
-from threading import Thread
-
-import os.path
+from functools import lru_cache
+import traceback
+from threading import Thread, Event, Timer, Lock
+from queue import Queue
 
 from dearpygui.core import *
 from dearpygui.simple import *
@@ -28,6 +28,102 @@ import wavewriter
 ''' Declare WaveWriter object '''
 device = wavewriter.WaveWriter()
 
+''' Device worker '''
+# Blocking device operations are queued here and run in order off the GUI thread
+device_queue = Queue()
+
+def run_device_queue():
+    for job in iter(device_queue.get, None):
+        # Failed jobs restore their own controls: log + keep worker running
+        try:
+            job()
+        except Exception:
+            traceback.print_exc()
+
+''' Item names updated from serial thread '''
+AMP_TAG = "##CurrentAmplitude"
+STIM_TAG = "##StimulationStatus"
+
+''' Item groups enabled + disabled together '''
+INPUT_ITEMS = ("Participant##input", "Session ID##input", "Age##input",
+               "Sex##input")
+WAVEFORM_ITEMS = ("Waveform##input", "Frequency (Hz)##input",
+                  "Duration (s)##input", "Send", "Stimulate")
+DATA_ITEMS = ("Start", "Discomfort threshold##input", "Pain threshold##input",
+              "Amplitude##input", "Measurement##input", "Save measure")
+
+def set_enabled(items, enabled):
+    '''
+    Enables or disables each named item
+    '''
+    for item in items:
+        configure_item(item, enabled=enabled)
+
+''' Status updates: skip writes that would not change the item '''
+last_values = {}
+last_colors = {}
+
+# Called from GUI, device worker + serial threads: check and write together
+status_lock = Lock()
+
+def set_status(item, value):
+    '''
+    Sets item value if changed
+    '''
+    with status_lock:
+        if last_values.get(item) != value:
+            set_value(item, value)
+            last_values[item] = value
+
+def set_color(item, color):
+    '''
+    Sets item color if changed
+    '''
+    color = tuple(color)
+    with status_lock:
+        if last_colors.get(item) != color:
+            configure_item(item, color=list(color))
+            last_colors[item] = color
+
+# Amplitude labels: dearpygui 0.x label text must be str
+# Amplitudes take few distinct values so cache the strings
+amplitude_labels = {}
+
+def amplitude_label(amplitude):
+    '''
+    Returns cached string for amplitude
+    '''
+    label = amplitude_labels.get(amplitude)
+    if label is None:
+        label = amplitude_labels[amplitude] = str(amplitude)
+    return label
+
+''' Define waveforms '''
+WAVEFORMS = ("Tonic", "Sinusoidal", "Wavelet", "Offset wavelet",
+             "Sawtooth modulated")
+
+# Generators: (amplitude [mA], frequency [Hz]) -> (v, t)
+WAVEFORM_GENERATORS = {
+    "Tonic": lambda a, f: wavewriter.generate_tonic(
+        a, f,
+        30, # us
+        biphasic = True),
+    "Sinusoidal": lambda a, f: wavewriter.generate_sine(
+        a, f,
+        1), # Cycles
+    "Wavelet": lambda a, f: wavewriter.generate_wavelet(
+        a, f,
+        40, # Hz modulating
+        4000), # Standard deviation
+    "Offset wavelet": lambda a, f: wavewriter.generate_wavelet_modulated(
+        a, f,
+        40, # Hz modulating
+        4000), # Standard deviation
+    "Sawtooth modulated": lambda a, f: wavewriter.generate_sawtooth_modulated(
+        a, f,
+        20), # Hz modulating
+}
+
 class Interface:
     '''
     Contains parameters for determining device state
@@ -42,10 +138,19 @@ class Interface:
     def __init__(self):
         self.connected = False    # Whether connected to device
         self.inputCheck = False   # Whether inputs appropriate
-        self.ready = False
+        self.ready_event = Event() # Set when serial monitor should read
+
+        # Session file: opened on start, written on writer thread at end
+        self.file = None
+        self.writer_thread = None
+
+        # Timer ending timed stimulation
+        self.stim_timer = None
         
-        self.amplitudes = []
-        self.measures = []
+        # Measurement buffers: doubled in size when full
+        self.capacity = 128
+        self.amplitudes = np.empty(self.capacity, dtype=np.int32)
+        self.measures = np.empty(self.capacity, dtype=np.int32)
         self.num_measures = 0
 
         self.current_amplitude = 0
@@ -61,7 +166,7 @@ class Interface:
         Called when starting session
         Gets values for inputs
         Checks values
-        Creates file
+        Creates file (exclusive: fails if already exists)
         Sets flag to indicate whether OK to continue with current inputs
         '''
         # Get data from inputs
@@ -72,24 +177,26 @@ class Interface:
 
         # Check inputs
         if self.participantID == '':
-            set_value("##OverallStatus", "Enter participant ID")
+            set_status("##OverallStatus", "Enter participant ID")
             self.inputCheck = False
             return
         if self.sessionID == '':
-            set_value("##OverallStatus", "Enter session ID")
+            set_status("##OverallStatus", "Enter session ID")
             self.inputCheck = False
             return
         if self.age == '':
-            set_value("##OverallStatus", "Enter age")
+            set_status("##OverallStatus", "Enter age")
             self.inputCheck = False
             return
 
         # Create filepath
         self.filename = self.participantID + '_' + self.sessionID + '.csv'
 
-        # Check if file already exists
-        if os.path.exists(self.filename):
-            set_value("##OverallStatus", "File already exists")
+        # Create file: exclusive open fails if file already exists
+        try:
+            self.file = open(self.filename, 'x', newline='', buffering=1<<16)
+        except FileExistsError:
+            set_status("##OverallStatus", "File already exists")
             self.inputCheck = False
             return
 
@@ -114,18 +221,34 @@ interface = Interface()
 def connect_callback(sender, data):
     '''
     Runs when connect button clicked
+    Queues connection to device
+    '''
+    # Prevent repeat clicks while connecting
+    configure_item("Connect", enabled=False)
+    set_status("##OverallStatus", "Connecting to device")
+
+    # Connect on device worker
+    device_queue.put(connect_device)
+
+def connect_device():
+    '''
+    Runs on device worker
     Connects to device
     Enables start button
     '''
     # Connect to device
-    device.connect()
+    try:
+        device.connect()
+        device.ser.timeout = 0.1 # Serial reads block for at most 100ms
+    except Exception:
+        # Allow retry
+        configure_item("Connect", enabled=True)
+        set_status("##OverallStatus", "Connection failed")
+        raise
     interface.connected = True
 
     # Enable demographic inputs
-    configure_item("Participant##input", enabled=True)
-    configure_item("Session ID##input", enabled=True)
-    configure_item("Age##input", enabled=True)
-    configure_item("Sex##input", enabled=True)
+    set_enabled(INPUT_ITEMS, True)
 
     # Reconfigure start -> end session
     configure_item("Connect", enabled=False)
@@ -134,9 +257,9 @@ def connect_callback(sender, data):
     configure_item("End session", enabled=False)
 
     # Update status
-    set_value("##DeviceStatus", "Connected")
-    configure_item("##DeviceStatus", color=[0,255,0])
-    set_value("##OverallStatus", "Device connected")
+    set_status("##DeviceStatus", "Connected")
+    set_color("##DeviceStatus", [0,255,0])
+    set_status("##OverallStatus", "Device connected")
 
 # Start session
 def startSession_callback(sender, data):
@@ -161,20 +284,22 @@ def startSession_callback(sender, data):
         Also: check files, etc.
     '''
     interface.parseInputs()
+
+    # If session parameters not OK, stop here
+    if not (interface.inputCheck):
+        return
+
     # Disable all inputs
-    configure_item("Participant##input", enabled=False)
-    configure_item("Session ID##input", enabled=False)
-    configure_item("Age##input", enabled=False)
-    configure_item("Sex##input", enabled=False)
+    set_enabled(INPUT_ITEMS, False)
 
     # Reconfigure start -> end session
     configure_item("End session", enabled=True, callback=endSession_callback)
     configure_item("Start session", enabled=False)
 
     # Update status
-    set_value("##SessionStatus", "Started")
-    configure_item("##SessionStatus", color=[0,255,0])
-    set_value("##OverallStatus", "Session started")
+    set_status("##SessionStatus", "Started")
+    set_color("##SessionStatus", [0,255,0])
+    set_status("##OverallStatus", "Session started")
 
     # Enable running experiment
     configure_item("Waveform##input", enabled=True)
@@ -194,60 +319,72 @@ def endSession_callback(sender, data):
     Updates all statuses
     Allows new session to be started
     '''
+    # Pending timed stop must not run after session ends
+    cancel_stimulation_timer()
+
     # Disconnect from system
 
     # Get data
-    participant = get_value("Participant##input")
-    session = get_value("Session ID##input")
-    age = get_value("Age##input")
-    sex = get_value("Sex##input")
-
     pain_threshold = get_value("Pain threshold##input")
     discomfort_threshold = get_value("Discomfort threshold##input")
 
-    # Save data
-    with open(interface.filename, 'w') as file:
-        # Write header to file
-        file.write("Participant ID, session ID, age, sex\n")
-        file.write(f"{participant}, {session}, {age}, {sex}\n\n")
-        file.write("Discomfort threshold, Pain threshold\n")
-        file.write(f"{discomfort_threshold}, {pain_threshold}\n\n")
-        file.write("Amplitude, Measurement\n")
-
-        # Write data to file
-        for idx in range(interface.num_measures):
-            file.write(f"{interface.amplitudes[idx]}, {interface.measures[idx]}\n")
-
-        file.close()
+    # Header lines, in file order
+    header = [
+        "Participant ID, session ID, age, sex\n",
+        f"{interface.participantID}, {interface.sessionID}, "
+        f"{interface.age}, {interface.sex}\n\n",
+        "Discomfort threshold, Pain threshold\n",
+        f"{discomfort_threshold}, {pain_threshold}\n\n",
+        "Amplitude, Measurement\n"
+    ]
+
+    # Save data on writer thread: copies so buffers can be reused
+    # Not a daemon: interpreter waits for the file to be written on exit
+    num_measures = interface.num_measures
+    interface.writer_thread = Thread(target=write_session,
+                                     args=(interface.file, header,
+                                           interface.amplitudes[:num_measures].copy(),
+                                           interface.measures[:num_measures].copy()))
+    interface.writer_thread.start()
+    interface.file = None
 
     # Reset flags
     interface.connected = False
-    interface.ready = False
+    interface.ready_event.clear()
 
     # Re-configure stop -> start session
     configure_item("Connect", enabled=True, callback=connect_callback)
     configure_item("Start session", enabled=False)
     configure_item("End session", enabled=False)
 
-    configure_item("Waveform##input", enabled=False)
-    configure_item("Frequency (Hz)##input", enabled=False)
-    configure_item("Duration (s)##input", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("Stimulate", enabled=False)
+    set_enabled(WAVEFORM_ITEMS, False)
 
-    configure_item("Start", enabled=False)
-    configure_item("Discomfort threshold##input", enabled=False)
-    configure_item("Pain threshold##input", enabled=False)
-    configure_item("Amplitude##input", enabled=False)
-    configure_item("Measurement##input", enabled=False)
-    configure_item("Save measure", enabled=False)
+    set_enabled(DATA_ITEMS, False)
 
     # Update status
-    set_value("##SessionStatus", "Not started")
-    configure_item("##SessionStatus", color=[255,0,0])
-    set_value("##DeviceStatus", "Not connected")
-    configure_item("##DeviceStatus", color=[255,0,0])
-    set_value("##OverallStatus", "Ready to connect")
+    set_status("##SessionStatus", "Not started")
+    set_color("##SessionStatus", [255,0,0])
+    set_status("##DeviceStatus", "Not connected")
+    set_color("##DeviceStatus", [255,0,0])
+    set_status("##OverallStatus", "Ready to connect")
+
+# Generate waveform
+@lru_cache(maxsize=32)
+def generate_waveform(waveform, frequency, amplitude):
+    '''
+    Generates named waveform
+    Converts to device format
+    Returns converted samples
+    Cached: repeat sends with same parameters reuse result
+    '''
+    v, t = WAVEFORM_GENERATORS[waveform](amplitude, frequency)
+
+    # Convert to device format
+    # Scaling is device-specific so stays in wavewriter
+    # Runs once per cached waveform, on the device worker
+    v, t = wavewriter.convert_waveform(v, t)
+
+    return v
 
 # Stimulate callback
 def send_waveform_callback(sender, data):
@@ -257,8 +394,7 @@ def send_waveform_callback(sender, data):
     '''
     # Get intended waveform
     waveform_id = get_value("Waveform##input")
-    waveforms = ["Tonic", "Sinusoidal", "Wavelet", "Offset wavelet", "Sawtooth modulated"]
-    waveform = waveforms[waveform_id]
+    waveform = WAVEFORMS[waveform_id]
     print(waveform)
 
     # Get frequency
@@ -270,57 +406,38 @@ def send_waveform_callback(sender, data):
     # Send waveform
     print(f"{waveform}: {frequency}Hz")
     
-    if waveform == 'Tonic':
-        v, t = wavewriter.generate_tonic(
-            amplitude, # mA
-            frequency, # Hz
-            30, # us
-            biphasic = True
-        )
-        
-    elif waveform == 'Sinusoidal':
-        v, t = wavewriter.generate_sine(
-            amplitude, # mA
-            frequency, # Hz
-            1 # Cycles
-        )
-        
-    elif waveform == 'Wavelet':
-        v, t = wavewriter.generate_wavelet(
-            amplitude, # mA
-            frequency, # Hz
-            40, # Hz modulating
-            4000 # Standard deviation
-        )
-        
-    elif waveform == 'Offset wavelet':
-        v, t = wavewriter.generate_wavelet_modulated(
-            amplitude, # mA
-            frequency, # Hz
-            40, # Hz modulating
-            4000, # Standard deviation
-        )
-
-    elif waveform == 'Sawtooth modulated':
-        v, t = wavewriter.generate_sawtooth_modulated(
-            amplitude, # mA
-            frequency, # Hz
-            20 # Hz modulating
-        )
-    
     # Deactivate stimulate button (if active)
     configure_item("Stimulate", enabled=False)
     configure_item("Send", enabled=False)
     configure_item("End session", enabled=False)
-    
-    # Send waveform
-    v, t = wavewriter.convert_waveform(v, t)
-    device.send_waveform(v)
+
+    # Generate + send on device worker
+    device_queue.put(lambda: send_waveform(waveform, frequency, amplitude))
+
+def send_waveform(waveform, frequency, amplitude):
+    '''
+    Runs on device worker
+    Generates waveform if not already cached
+    Sends to device
+    Re-enables stimulation controls
+    '''
+    try:
+        # Generate waveform if not already cached
+        v = generate_waveform(waveform, frequency, amplitude)
+
+        # Send waveform
+        device.send_waveform(v)
+    except Exception:
+        # Allow resend or ending session
+        configure_item("Send", enabled=True)
+        configure_item("End session", enabled=True)
+        set_status("##OverallStatus", "Send failed")
+        raise
 
     # Update current waveform display
     set_value("##CurrentWaveform", f"{waveform}")
     set_value("##CurrentFrequency", f"{frequency}")
-    set_value("##CurrentAmplitude", f"{interface.current_amplitude}")
+    set_status(AMP_TAG, amplitude_label(interface.current_amplitude))
     
     # Activate stimulate button
     configure_item("Duration (s)##input", enabled=True)
@@ -328,14 +445,9 @@ def send_waveform_callback(sender, data):
     configure_item("Send", enabled=True)
     configure_item("End session", enabled=True)
 
-    configure_item("Start", enabled=True)
-    configure_item("Discomfort threshold##input", enabled=True)
-    configure_item("Pain threshold##input", enabled=True)
-    configure_item("Amplitude##input", enabled=True)
-    configure_item("Measurement##input", enabled=True)
-    configure_item("Save measure", enabled=True)
+    set_enabled(DATA_ITEMS, True)
 
-    interface.ready = True
+    interface.ready_event.set()
 
 # Run stimulation
 def start_stimulation_status():
@@ -346,8 +458,8 @@ def start_stimulation_status():
     configure_item("Send", enabled=False)
     configure_item("End session", enabled=False)
 
-    set_value("##StimulationStatus", "On")
-    configure_item("##StimulationStatus", color=[0,255,0])
+    set_status(STIM_TAG, "On")
+    set_color(STIM_TAG, [0,255,0])
 
 def stop_stimulation_status():
     # Reactivate buttons
@@ -357,37 +469,69 @@ def stop_stimulation_status():
     configure_item("Send", enabled=True)
     configure_item("End session", enabled=True)
 
-    set_value("##StimulationStatus", "Off")
-    configure_item("##StimulationStatus", color=[255,0,0])
+    set_status(STIM_TAG, "Off")
+    set_color(STIM_TAG, [255,0,0])
 
 def start_stimulation():
     # Update status
     start_stimulation_status()
 
     # Run stimulation
-    device.start()
+    try:
+        device.start()
+    except Exception:
+        stop_stimulation_status()
+        set_status("##OverallStatus", "Stimulation failed")
+        raise
 
 def stop_stimulation():
     # Stop stimulation
-    device.stop()
+    try:
+        device.stop()
+    except Exception:
+        # Stop left enabled to retry
+        set_status("##OverallStatus", "Stop failed")
+        raise
 
     # Update status
     stop_stimulation_status()
 
 def start_stimulation_callback(sender, data):
-    start_stimulation()
+    # Pending timed stop must not end this stimulation
+    cancel_stimulation_timer()
+    device_queue.put(start_stimulation)
 
 def stop_stimulation_callback(sender, data):
-    stop_stimulation()
+    cancel_stimulation_timer()
+    device_queue.put(stop_stimulation)
+
+def cancel_stimulation_timer():
+    if interface.stim_timer is not None:
+        interface.stim_timer.cancel()
+        interface.stim_timer = None
 
 # Run stimulation callback
 def stimulate_callback(sender, data):
     # Get duration
     dur = get_value("Duration (s)##input")
     
-    start_stimulation()
-    time.sleep(dur)
-    stop_stimulation()
+    # Start now, queue stop once duration elapsed
+    cancel_stimulation_timer()
+    device_queue.put(start_stimulation)
+    interface.stim_timer = Timer(dur, device_queue.put, args=(stop_stimulation,))
+    interface.stim_timer.start()
+
+# Session file writer
+def write_session(file, header, amplitudes, measures):
+    '''
+    Runs on writer thread
+    Writes header + measurements to file
+    Closes file
+    '''
+    lines = header + [f"{a}, {m}\n" for a, m in zip(amplitudes.tolist(),
+                                                     measures.tolist())]
+    with file:
+        file.write("".join(lines))
 
 # Add measurement callback
 def add_measure_callback(sender, data):
@@ -395,9 +539,15 @@ def add_measure_callback(sender, data):
     amplitude = get_value("Amplitude##input")
     measure = get_value("Measurement##input")
 
+    # Grow buffers if full
+    if interface.num_measures == interface.capacity:
+        interface.capacity *= 2
+        interface.amplitudes = np.resize(interface.amplitudes, interface.capacity)
+        interface.measures = np.resize(interface.measures, interface.capacity)
+
     # Save data
-    interface.amplitudes.append(amplitude)
-    interface.measures.append(measure)
+    interface.amplitudes[interface.num_measures] = amplitude
+    interface.measures[interface.num_measures] = measure
 
     # Reset values
     interface.num_measures += 1
@@ -405,25 +555,29 @@ def add_measure_callback(sender, data):
 
 # Monitor serial port
 def monitor_serial():
-    while 1:
-        if interface.ready == True:
-            response = device.ser.readline()
-            if response:
-                val = response.decode("utf-8").strip('\x00')#.rstrip('x\00')
-                print(val)
-
-                if val == interface.greeting:
-                     print("Greeting received")
-                elif 'On' in val:
-                    start_stimulation_status()
-                elif 'Off' in val:
-                    stop_stimulation_status()
-                else:
-                    try:
-                        interface.current_amplitude = int(val)
-                        set_value("##CurrentAmplitude", f"{interface.current_amplitude}")
-                    except:
-                        pass
+    while True:
+        # Sleep until a waveform has been sent
+        interface.ready_event.wait()
+
+        # Blocks until a line arrives or the serial timeout expires
+        # Compared as bytes: no decode needed
+        val = device.ser.readline().strip(b'\x00\r\n ')
+        if not val:
+            continue
+
+        if val == interface.greeting:
+             print("Greeting received")
+        elif b'On' in val:
+            start_stimulation_status()
+        elif b'Off' in val:
+            stop_stimulation_status()
+        else:
+            try:
+                interface.current_amplitude = int(val) # int() accepts bytes
+            except ValueError:
+                pass
+            else:
+                set_status(AMP_TAG, amplitude_label(interface.current_amplitude))
 
     
 
@@ -502,9 +656,7 @@ with window("ONI"):
         add_spacing(count=3)
 
         # Add input: waveform
-        add_radio_button("Waveform##input", items=["Tonic", "Sinusoidal",
-                                                   "Wavelet", "Offset wavelet",
-                                                  "Sawtooth modulated"], enabled=False)
+        add_radio_button("Waveform##input", items=list(WAVEFORMS), enabled=False)
 
         # Add input: frequency
         add_input_int("Frequency (Hz)##input", default_value=0, width=100,
@@ -533,11 +685,11 @@ with window("ONI"):
 
         add_text("Stimulation:")
         add_same_line(xoffset=150)
-        add_label_text("##StimulationStatus", default_value="Off", color=[255,0,0])
+        add_label_text(STIM_TAG, default_value="Off", color=[255,0,0])
 
         add_text("Amplitude (mA):")
         add_same_line(xoffset=150)
-        add_label_text("##CurrentAmplitude", default_value="Not specified")
+        add_label_text(AMP_TAG, default_value="Not specified")
 
         # Add input: duration
         add_spacing(count=3)
@@ -591,6 +743,8 @@ def startGUI():
     # Start main window
     start_dearpygui(primary_window="ONI")
 
+deviceThread = Thread(target=run_device_queue, daemon=True)
+deviceThread.start()
 serialThread = Thread(target=monitor_serial, daemon=True)
 serialThread.start()
 startGUI()
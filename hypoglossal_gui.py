@@ -14,8 +14,7 @@ Saves data to file
 
 ## Imports
 import numpy as np
-import time
-from threading import Thread
+from threading import Thread, Event, Timer, Lock
 
 import os.path
 
@@ -28,6 +27,23 @@ import wavewriter
 ''' Declare WaveWriter object '''
 device = wavewriter.WaveWriter()
 
+# Held for device commands: GUI thread and stimulation Timer share the port
+device_lock = Lock()
+
+''' Item groups enabled + disabled together '''
+SESSION_INPUTS = ("Participant##input", "Age##input", "Sex##input")
+STIM_CONTROLS = ("Duration (s)##input", "Load", "Stimulate", "Start")
+MEASURE_INPUTS = ("Tolerance threshold (mA)##input",
+                  "Hyomental distance (mm)##input",
+                  "Tongue diameter (mm)##input")
+
+def set_enabled(items, enabled):
+    '''
+    Enables or disables each named item
+    '''
+    for item in items:
+        configure_item(item, enabled=enabled)
+
 class Interface:
     '''
     Contains parameters for determining device state
@@ -42,26 +58,40 @@ class Interface:
     def __init__(self):
         self.connected = False    # Whether connected to device
         self.inputCheck = False   # Whether inputs appropriate
-        self.ready = False
+        self.ready_event = Event() # Set when serial monitor should read
         self.calibrated = False
 
         # Number of times to repeat all measures
         self.num_repeats = 10
         
         # Multipliers: output = threshold x multiplier
-        self.multiplier_values = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0]
-        self.num_multipliers = len(self.multiplier_values)
-        self.multiplier_values = np.tile(self.multiplier_values, self.num_repeats)
+        multipliers = np.array([0.0, 0.2, 0.4, 0.6, 0.8, 1.0], dtype=np.float32)
+        self.num_multipliers = len(multipliers)
         self.amplitude_id = 0
 
-        self.NUM_MEASURES = len(self.multiplier_values)
-        self.multipliers = np.arange(self.NUM_MEASURES)
+        self.NUM_MEASURES = self.num_multipliers * self.num_repeats
+        self.multipliers = np.arange(self.NUM_MEASURES, dtype=np.int32)
+
+        # One record per measure, in file row order
+        self.records = np.zeros(self.NUM_MEASURES, dtype=[
+            ('amplitude', np.int32),
+            ('multiplier', np.float32),
+            ('hyomental', np.float32),
+            ('tongue', np.float32)
+        ])
+        self.records['multiplier'] = np.tile(multipliers, self.num_repeats)
 
-        self.measures_hyomental = np.zeros(self.NUM_MEASURES)
-        self.measures_tongue = np.zeros(self.NUM_MEASURES)
+        # Amplitude sent for each measure: 50mA x multiplier
+        self.amplitude_table = (50 * self.records['multiplier']).astype(np.int32)
 
         self.current_amplitude = 50
 
+        # Timer ending timed stimulation
+        self.stim_timer = None
+
+        # Converted waveforms by amplitude
+        self.wave_cache = {}
+
         # Messages
         self.greeting = b'Hello'
         self.on = b'On\r\n'
@@ -135,14 +165,14 @@ def connect_callback(sender, data):
     Enables start button
     '''
     # Connect to device
-    device.connect()
+    with device_lock:
+        device.connect()
+        device.ser.timeout = 0.1 # Serial reads block for at most 100ms
     interface.connected = True
 
     # Enable demographic inputs
-    configure_item("Participant##input", enabled=True)
 #    configure_item("Session ID##input", enabled=True)
-    configure_item("Age##input", enabled=True)
-    configure_item("Sex##input", enabled=True)
+    set_enabled(SESSION_INPUTS, True)
 
     # Reconfigure start -> end session
     configure_item("Connect", enabled=False)
@@ -189,14 +219,15 @@ def startSession_callback(sender, data):
             interface.multipliers = np.concatenate((interface.multipliers,
                                                     np.random.permutation(np.arange(rep*interface.num_multipliers, (rep*interface.num_multipliers)+interface.num_multipliers))))
 
+        # Build waveforms for measured amplitudes while calibrating
+        Thread(target=precompute_waveforms, daemon=True).start()
+
     else:
         return
 
     # Disable all inputs
-    configure_item("Participant##input", enabled=False)
 #    configure_item("Session ID##input", enabled=False)
-    configure_item("Age##input", enabled=False)
-    configure_item("Sex##input", enabled=False)
+    set_enabled(SESSION_INPUTS, False)
 
     # Reconfigure start -> end session
     configure_item("End session", enabled=True, callback=endSession_callback)
@@ -221,6 +252,9 @@ def endSession_callback(sender, data):
     Updates all statuses
     Allows new session to be started
     '''
+    # Pending timed stop must not run after session ends
+    cancel_stimulation_timer()
+
     # Disconnect from system
 
     # Get data
@@ -232,25 +266,26 @@ def endSession_callback(sender, data):
     threshold_current = get_value("Tolerance threshold (mA)##input")
 
     # Save data
-    with open(interface.filename, 'w') as file:
+    with open(interface.filename, 'w', buffering=1<<20, newline='') as file:
         # Write header to file
         file.write("Participant ID, age, sex\n")
         file.write(f"{participant}, {age}, {sex}\n\n")
         file.write(f"Threshold current: {threshold_current}\n")
         file.write("Amplitude, multiplier, hyomental distance, tongue diameter\n")
 
-        for idx in range(interface.NUM_MEASURES):
-            val_hyomental = interface.measures_hyomental[idx]
-            val_tongue = interface.measures_tongue[idx]
-            multiplier = interface.multiplier_values[idx]
-            amplitude = int(threshold_current * multiplier)
-            file.write(f"{amplitude}, {multiplier}, {val_hyomental}, {val_tongue}\n")
-
-        file.close()
+        # Write data to file in a single call
+        records = interface.records
+        records['amplitude'] = threshold_current * records['multiplier']
+        # str() keeps float32 values short (e.g. 0.2 not 0.20000000298023224)
+        lines = [f"{amplitude}, {multiplier!s}, {val_hyomental!s}, {val_tongue!s}\n"
+                 for amplitude, multiplier, val_hyomental, val_tongue
+                 in zip(records['amplitude'], records['multiplier'],
+                        records['hyomental'], records['tongue'])]
+        file.write("".join(lines))
 
     # Reset flags
     interface.connected = False
-    interface.ready = False
+    interface.ready_event.clear()
     interface.calibrated = False
 
     # Re-configure stop -> start session
@@ -258,14 +293,8 @@ def endSession_callback(sender, data):
     configure_item("Start session", enabled=False)
     configure_item("End session", enabled=False)
 
-    configure_item("Duration (s)##input", enabled=False)
-    configure_item("Load", enabled=False)
-    configure_item("Stimulate", enabled=False)
-
-    configure_item("Start", enabled=False)
-    configure_item("Tolerance threshold (mA)##input", enabled=False)
-    configure_item("Hyomental distance (mm)##input", enabled=False)
-    configure_item("Tongue diameter (mm)##input", enabled=False)
+    set_enabled(STIM_CONTROLS, False)
+    set_enabled(MEASURE_INPUTS, False)
     configure_item("Next", enabled=False)
     configure_item("Done calibration", enabled=False)
 
@@ -282,6 +311,31 @@ def send_waveform_callback(sender, data):
     configure_item("Done calibration", enabled=True)
     configure_item("Load", enabled=False)
 
+def generate_waveform(amplitude):
+    '''
+    Generates wavelet at given amplitude
+    Converts to device format
+    Returns converted samples
+    '''
+    v, t = wavewriter.generate_wavelet(
+        amplitude, # mA
+        10000, # Hz
+        40, # Hz modulating
+        4000 # Standard deviation
+    )
+    v, t = wavewriter.convert_waveform(v, t)
+
+    return v
+
+def precompute_waveforms():
+    '''
+    Runs on background thread
+    Caches waveform for each amplitude used in measures
+    '''
+    for amplitude in np.unique(interface.amplitude_table).tolist():
+        if amplitude not in interface.wave_cache:
+            interface.wave_cache[amplitude] = generate_waveform(amplitude)
+
 def send_waveform():
     '''
     Get data from amplitude and duration fields
@@ -290,13 +344,11 @@ def send_waveform():
 
     # Get amplitude
     print(interface.current_amplitude)
-        
-    v, t = wavewriter.generate_wavelet(
-        interface.current_amplitude, # mA
-        10000, # Hz
-        40, # Hz modulating
-        4000 # Standard deviation
-    )
+
+    # Use cached waveform if available
+    v = interface.wave_cache.get(interface.current_amplitude)
+    if v is None:
+        v = interface.wave_cache[interface.current_amplitude] = generate_waveform(interface.current_amplitude)
 
     # Deactivate stimulate button (if active)
     configure_item("Start", enabled=False)
@@ -306,23 +358,17 @@ def send_waveform():
     configure_item("Next", enabled=False)
     
     # Send waveform
-    v, t = wavewriter.convert_waveform(v, t)
-    device.send_waveform(v)
+    with device_lock:
+        device.send_waveform(v)
     
     # Activate stimulate button
-    configure_item("Duration (s)##input", enabled=True)
-    configure_item("Stimulate", enabled=True)
-    configure_item("Load", enabled=True)
+    set_enabled(STIM_CONTROLS, True)
     configure_item("End session", enabled=True)
-
-    configure_item("Start", enabled=True)
-    configure_item("Tolerance threshold (mA)##input", enabled=True)
-    configure_item("Hyomental distance (mm)##input", enabled=True)
-    configure_item("Tongue diameter (mm)##input", enabled=True)
+    set_enabled(MEASURE_INPUTS, True)
     if interface.calibrated:
         configure_item("Next", enabled=True)
 
-    interface.ready = True
+    interface.ready_event.set()
 
 # Run stimulation
 def start_stimulation_status():
@@ -358,29 +404,41 @@ def start_stimulation():
     start_stimulation_status()
 
     # Run stimulation
-    device.start()
+    with device_lock:
+        device.start()
 
 def stop_stimulation():
     # Stop stimulation
-    device.stop()
+    with device_lock:
+        device.stop()
 
     # Update status
     stop_stimulation_status()
 
 def start_stimulation_callback(sender, data):
+    # Pending timed stop must not end this stimulation
+    cancel_stimulation_timer()
     start_stimulation()
 
 def stop_stimulation_callback(sender, data):
+    cancel_stimulation_timer()
     stop_stimulation()
 
+def cancel_stimulation_timer():
+    if interface.stim_timer is not None:
+        interface.stim_timer.cancel()
+        interface.stim_timer = None
+
 # Run stimulation callback
 def stimulate_callback(sender, data):
     # Get duration
     dur = get_value("Duration (s)##input")
     
+    # Start now, stop on timer thread once duration elapsed
+    cancel_stimulation_timer()
     start_stimulation()
-    time.sleep(dur)
-    stop_stimulation()
+    interface.stim_timer = Timer(dur, stop_stimulation)
+    interface.stim_timer.start()
 
 # Add measurement callback
 def add_measure_callback(sender, data):
@@ -389,8 +447,9 @@ def add_measure_callback(sender, data):
     measure_tongue = get_value("Tongue diameter (mm)##input")
 
     # Save data
-    interface.measures_hyomental[interface.multipliers[interface.amplitude_id]] = measure_hyomental
-    interface.measures_tongue[interface.multipliers[interface.amplitude_id]] = measure_tongue
+    record = interface.records[interface.multipliers[interface.amplitude_id]]
+    record['hyomental'] = measure_hyomental
+    record['tongue'] = measure_tongue
 
     # Reset values
     interface.amplitude_id += 1
@@ -399,7 +458,7 @@ def add_measure_callback(sender, data):
     # If not at end: send new waveform
     if interface.amplitude_id < interface.NUM_MEASURES:
         # Set new amplitude
-        interface.current_amplitude = int(50 * interface.multiplier_values[interface.multipliers[interface.amplitude_id]])
+        interface.current_amplitude = int(interface.amplitude_table[interface.multipliers[interface.amplitude_id]])
 
         # Send new amplitude
         send_waveform()
@@ -409,14 +468,8 @@ def add_measure_callback(sender, data):
         configure_item("Start session", enabled=False)
         configure_item("End session", enabled=True)
 
-        configure_item("Duration (s)##input", enabled=False)
-        configure_item("Load", enabled=False)
-        configure_item("Stimulate", enabled=False)
-
-        configure_item("Start", enabled=False)
-        configure_item("Tolerance threshold (mA)##input", enabled=False)
-        configure_item("Hyomental distance (mm)##input", enabled=False)
-        configure_item("Tongue diameter (mm)##input", enabled=False)
+        set_enabled(STIM_CONTROLS, False)
+        set_enabled(MEASURE_INPUTS, False)
         configure_item("Next", enabled=False)
         
         # Update overall status
@@ -425,7 +478,7 @@ def add_measure_callback(sender, data):
 # Done calibration callback
 def done_calibration_callback(sender, data):
     # Send first amplitude
-    interface.current_amplitude = int(50 * interface.multiplier_values[interface.multipliers[interface.amplitude_id]])
+    interface.current_amplitude = int(interface.amplitude_table[interface.multipliers[interface.amplitude_id]])
 
     # Send new amplitude
     send_waveform()
@@ -438,25 +491,25 @@ def done_calibration_callback(sender, data):
 
 # Monitor serial port
 def monitor_serial():
-    while 1:
-        if interface.ready == True:
-            response = device.ser.readline()
-            if response:
-                val = response.decode("utf-8").strip('\x00')#.rstrip('x\00')
-                print(val)
-
-                if val == interface.greeting:
-                     print("Greeting received")
-                elif 'On' in val:
-                    start_stimulation_status()
-                elif 'Off' in val:
-                    stop_stimulation_status()
-                else:
-                    try:
-                        interface.current_amplitude = int(val)
-                        set_value("##CurrentAmplitude", f"{interface.current_amplitude}")
-                    except:
-                        pass
+    while True:
+        # Sleep until a waveform has been sent
+        interface.ready_event.wait()
+
+        # Blocks until a line arrives or the serial timeout expires
+        # Compared as bytes: no decode needed
+        val = device.ser.readline().strip(b'\x00\r\n ')
+        if not val:
+            continue
+
+        if val.startswith(b'On'):
+            start_stimulation_status()
+        elif val.startswith(b'Off'):
+            stop_stimulation_status()
+        elif val == interface.greeting:
+             print("Greeting received")
+        elif (val[1:] if val[:1] == b'-' else val).isdigit():
+            interface.current_amplitude = int(val)
+            set_value("##CurrentAmplitude", f"{interface.current_amplitude}")
     
 
 ''' Define window layout '''
@@ -23,12 +23,19 @@ Need to:
 ## Imports
 import numpy as np
 import time
+from functools import lru_cache
 from threading import Thread
 
 import os.path
 
-from dearpygui.core import *
-from dearpygui.simple import *
+from dearpygui.core import (
+    get_value, set_value, configure_item,
+    add_text, add_label_text, add_button, add_input_int, add_input_text,
+    add_radio_button, add_same_line, add_spacing, add_separator,
+    set_main_window_size, set_main_window_pos, set_main_window_title,
+    start_dearpygui
+)
+from dearpygui.simple import window, child
 
 # Import WaveWriter library
 import wavewriter
@@ -40,6 +47,79 @@ device = wavewriter.WaveWriter()
 NUM_WAVEFORMS = 8
 waveform_id = 0
 
+# Generators: amplitude (mA) -> (v, t)
+WAVEFORM_DISPATCH = {
+    'Tonic': lambda a: wavewriter.generate_tonic(
+        a,
+        40, # Hz
+        100, # us
+        biphasic = True),
+    'Nevro HF': lambda a: wavewriter.generate_tonic(
+        a,
+        10000, # Hz
+        30, # us
+        biphasic = True),
+    'Boston Burst': lambda a: wavewriter.generate_burst_boston(
+        a,
+        5, # Pulses per burst
+        500, # Hz intraburst
+        40, # Hz interburst
+        1000), # us pulsewidth
+    'Abbott Burst': lambda a: wavewriter.generate_burst_abbott(
+        a,
+        500, # Hz intraburst
+        40, # Hz interburst
+        1000), # us pulsewidth
+    'Sinusoidal': lambda a: wavewriter.generate_sine(
+        a,
+        2000, # Hz
+        1), # Cycles
+    'Russian': lambda a: wavewriter.generate_russian(
+        a,
+        2000, # Hz
+        40, # Hz (modulating)
+        10000), # us window length
+    'Wavelet': lambda a: wavewriter.generate_wavelet(
+        a,
+        2000, # Hz
+        40, # Hz modulating
+        4000), # Standard deviation
+    'Offset wavelet': lambda a: wavewriter.generate_wavelet_modulated(
+        a,
+        2000, # Hz
+        40, # Hz modulating
+        4000), # Standard deviation
+}
+
+''' Define results '''
+RESULT_COLUMNS = (
+    'Perception', 'Sensory', 'Motor', 'Discomfort', 'Pain',
+    'Pain Score', 'Electrode Pain', 'Paraesthesia Pain', 'Motor Pain'
+)
+
+''' Item groups enabled + disabled together '''
+SESSION_INPUTS = ("Participant##input", "Session ID##input", "Age##input",
+                  "Sex##input")
+STIM_CONTROLS = ("Amplitude (mA)##input", "Duration (s)##input", "Send",
+                 "Stimulate")
+# Left enabled after a failed send: no stimulating until resent
+SESSION_BUTTONS = ("Send", "End session", "Next waveform")
+SEND_BUTTONS = ("Stimulate",) + SESSION_BUTTONS
+# Inputs in RESULT_COLUMNS order
+RESULT_INPUTS = (
+    "Perception##input", "Sensory##input", "Motor##input",
+    "Discomfort##input", "Pain##input",
+    "Pain rating##input", "Electrode pain##input",
+    "Paraesthesia pain##input", "Motor pain##input"
+)
+
+def set_enabled(items, enabled):
+    '''
+    Enables or disables each named item
+    '''
+    for item in items:
+        configure_item(item, enabled=enabled)
+
 ''' Randomise waveforms '''
 
 ''' Define interface state '''
@@ -62,21 +142,14 @@ class Interface:
         self.waveform_id = 0
         self.NUM_WAVEFORMS = 8
         self.waveforms = np.arange(NUM_WAVEFORMS)
+        self.rng = np.random.default_rng()
         self.waveform_titles = [
             'Tonic', 'Nevro HF', 'Abbott Burst', 'Boston Burst',
             'Sinusoidal', 'Russian', 'Wavelet', 'Offset wavelet'
         ]
 
-        self.thresholds_perception = np.zeros(NUM_WAVEFORMS)
-        self.thresholds_sensory = np.zeros(NUM_WAVEFORMS)
-        self.thresholds_motor = np.zeros(NUM_WAVEFORMS)
-        self.thresholds_discomfort = np.zeros(NUM_WAVEFORMS)
-        self.thresholds_pain = np.zeros(NUM_WAVEFORMS)
-        
-        self.pain_scores = np.zeros(NUM_WAVEFORMS)
-        self.electrode_pain = np.zeros(NUM_WAVEFORMS)
-        self.paraesthesia_pain = np.zeros(NUM_WAVEFORMS)
-        self.motor_pain = np.zeros(NUM_WAVEFORMS)
+        # Results: one row per waveform, columns as RESULT_COLUMNS
+        self.results = np.zeros((NUM_WAVEFORMS, len(RESULT_COLUMNS)))
 
     # Parse inputs
     def parseInputs(self):
@@ -146,10 +219,7 @@ def connect_callback(sender, data):
     interface.connected = True
 
     # Enable demographic inputs
-    configure_item("Participant##input", enabled=True)
-    configure_item("Session ID##input", enabled=True)
-    configure_item("Age##input", enabled=True)
-    configure_item("Sex##input", enabled=True)
+    set_enabled(SESSION_INPUTS, True)
 
     # Reconfigure start -> end session
     configure_item("Connect", enabled=False)
@@ -190,17 +260,14 @@ def startSession_callback(sender, data):
     if (interface.inputCheck):
         # Reset waveforms and shuffle
         interface.waveform_id = 0
-        np.random.shuffle(interface.waveforms) 
+        interface.waveforms = interface.rng.permutation(NUM_WAVEFORMS)
 
     # Otherwise, set an error and stop here
     else:
         return
 
     # Disable all inputs
-    configure_item("Participant##input", enabled=False)
-    configure_item("Session ID##input", enabled=False)
-    configure_item("Age##input", enabled=False)
-    configure_item("Sex##input", enabled=False)
+    set_enabled(SESSION_INPUTS, False)
 
     # Reconfigure start -> end session
     configure_item("End session", enabled=True, callback=endSession_callback)
@@ -217,16 +284,7 @@ def startSession_callback(sender, data):
     configure_item("Send", enabled=True, callback=send_waveform_callback)
     configure_item("Stimulate", enabled=False)
 
-    configure_item("Perception##input", enabled=True)
-    configure_item("Sensory##input", enabled=True)
-    configure_item("Motor##input", enabled=True)
-    configure_item("Discomfort##input", enabled=True)
-    configure_item("Pain##input", enabled=True)
-    
-    configure_item("Pain rating##input", enabled=True)
-    configure_item("Electrode pain##input", enabled=True)
-    configure_item("Paraesthesia pain##input", enabled=True)
-    configure_item("Motor pain##input", enabled=True)
+    set_enabled(RESULT_INPUTS, True)
 
     configure_item("Next waveform", enabled=True,
                    callback=nextWaveform_callback)
@@ -243,49 +301,32 @@ def endSession_callback(sender, data):
     Allows new session to be started
     '''
     # Disconnect from system
-    print(f"{type(interface.waveforms)}, {type(interface.thresholds_perception)}, {type(interface.thresholds_sensory)}, {type(interface.thresholds_motor)}, {type(interface.thresholds_discomfort)}, {type(interface.thresholds_pain)}")
 
     # Save all data
     # Write header to file
-    with open(interface.filename, 'w') as file:
-        # Write header to file
-        file.write("Waveform, Perception, Sensory, Motor, Discomfort, Pain, Pain Score, Electrode Pain, Paraesthesia Pain, Motor Pain\n")
+    # One row per waveform: title then scores
+    data = np.column_stack((np.array(interface.waveform_titles, dtype=object),
+                            interface.results))
 
-        # Write data to file
-        for idx in range(NUM_WAVEFORMS):
-            file.write(f"{interface.waveform_titles[idx]}, {interface.thresholds_perception[idx]}, {interface.thresholds_sensory[idx]}, {interface.thresholds_motor[idx]}, {interface.thresholds_discomfort[idx]}, {interface.thresholds_pain[idx]}, {interface.pain_scores[idx]}, {interface.electrode_pain[idx]}, {interface.paraesthesia_pain[idx]}, {interface.motor_pain[idx]}\n")
-
-        file.close()
+    with open(interface.filename, 'w', newline='') as file:
+        # Write header + data to file
+        np.savetxt(file, data, fmt="%s", delimiter=", ", comments='',
+                   header=", ".join(('Waveform',) + RESULT_COLUMNS))
 
     # Reset flags
     interface.connected = False
 
     # Re-enable inputs
-    configure_item("Participant##input", enabled=False)
-    configure_item("Session ID##input", enabled=False)
-    configure_item("Age##input", enabled=False)
-    configure_item("Sex##input", enabled=False)
+    set_enabled(SESSION_INPUTS, False)
 
     # Re-configure stop -> start session
     configure_item("Connect", enabled=True, callback=connect_callback)
     configure_item("Start session", enabled=False)
     configure_item("End session", enabled=False)
 
-    configure_item("Amplitude (mA)##input", enabled=False)
-    configure_item("Duration (s)##input", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("Stimulate", enabled=False)
+    set_enabled(STIM_CONTROLS, False)
 
-    configure_item("Perception##input", enabled=False)
-    configure_item("Sensory##input", enabled=False)
-    configure_item("Motor##input", enabled=False)
-    configure_item("Discomfort##input", enabled=False)
-    configure_item("Pain##input", enabled=False)
-    
-    configure_item("Pain rating##input", enabled=False)
-    configure_item("Electrode pain##input", enabled=False)
-    configure_item("Paraesthesia pain##input", enabled=False)
-    configure_item("Motor pain##input", enabled=False)
+    set_enabled(RESULT_INPUTS, False)
 
     configure_item("Next waveform", enabled=False)
 
@@ -296,6 +337,20 @@ def endSession_callback(sender, data):
     configure_item("##DeviceStatus", color=[255,0,0])
     set_value("##OverallStatus", "Ready to connect")
 
+# Generate + convert waveform
+@lru_cache(maxsize=32)
+def generate_waveform(title, amplitude):
+    '''
+    Generates named waveform at given amplitude
+    Converts to device format
+    Returns converted samples
+    Cached: repeat sends with same parameters reuse result
+    '''
+    v, t = WAVEFORM_DISPATCH[title](amplitude)
+    v, t = wavewriter.convert_waveform(v, t)
+
+    return v
+
 # Stimulate callback
 def send_waveform_callback(sender, data):
     '''
@@ -305,91 +360,37 @@ def send_waveform_callback(sender, data):
     # Get amplitude
     amplitude = get_value("Amplitude (mA)##input")
 
-    # Send waveform
-        # Use waveforms[waveform_id] to determine which waveform to generate
-        # e.g. switch/case using this to determine which function to run
+    # Get waveform
     current_waveform = interface.waveforms[interface.waveform_id]
-    
-    if interface.waveform_titles[current_waveform] == 'Tonic':
-        v, t = wavewriter.generate_tonic(
-            amplitude, # mA
-            40, # Hz
-            100, # us
-            biphasic = True
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Nevro HF':
-        v, t = wavewriter.generate_tonic(
-            amplitude, # mA
-            10000, # Hz
-            30, # us
-            biphasic = True
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Boston Burst':
-        v, t = wavewriter.generate_burst_boston(
-            amplitude, # mA
-            5, # Pulses per burst
-            500, # Hz intraburst
-            40, # Hz interburst
-            1000 # us pulsewidth
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Abbott Burst':
-        v, t = wavewriter.generate_burst_abbott(
-            amplitude, # mA
-            500, # Hz intraburst
-            40, # Hz interburst
-            1000, # us pulsewidth
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Sinusoidal':
-        v, t = wavewriter.generate_sine(
-            amplitude, # mA
-            2000, # Hz
-            1 # Cycles
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Russian':
-        v, t = wavewriter.generate_russian(
-            amplitude, # mA
-            2000, # Hz
-            40, # Hz (modulating)
-            10000 # us window length
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Wavelet':
-        v, t = wavewriter.generate_wavelet(
-            amplitude, # mA
-            2000, # Hz
-            40, # Hz modulating
-            4000 # Standard deviation
-        )
-        
-    elif interface.waveform_titles[current_waveform] == 'Offset wavelet':
-        v, t = wavewriter.generate_wavelet_modulated(
-            amplitude, # mA
-            2000, # Hz
-            40, # Hz modulating
-            4000, # Standard deviation
-        )
+    title = interface.waveform_titles[current_waveform]
 
-    
     # Deactivate stimulate button (if active)
-    configure_item("Stimulate", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("End session", enabled=False)
-    configure_item("Next waveform", enabled=False)
+    set_enabled(SEND_BUTTONS, False)
     
-    # Send waveform
-    v, t = wavewriter.convert_waveform(v, t)
-    device.send_waveform(v)
+    # Generate + send off GUI thread
+    Thread(target=send_waveform, args=(title, amplitude), daemon=True).start()
+
+def send_waveform(title, amplitude):
+    '''
+    Runs on send thread
+    Generates + converts waveform if not already cached
+    Sends waveform
+    Reactivates buttons when done
+    '''
+    try:
+        # Generate + convert waveform if not already cached
+        v = generate_waveform(title, amplitude)
+
+        # Send waveform
+        device.send_waveform(v)
+    except Exception:
+        # Allow resend, next waveform or ending session
+        set_enabled(SESSION_BUTTONS, True)
+        set_value("##OverallStatus", "Send failed")
+        raise
     
     # Activate stimulate button
-    configure_item("Stimulate", enabled=True)
-    configure_item("Send", enabled=True)
-    configure_item("End session", enabled=True)
-    configure_item("Next waveform", enabled=True)
+    set_enabled(SEND_BUTTONS, True)
     
 # Run stimulation callback
 def stimulate_callback(sender, data):
@@ -397,41 +398,42 @@ def stimulate_callback(sender, data):
     dur = get_value("Duration (s)##input")
     
     # Deactivate buttons
-    configure_item("Stimulate", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("End session", enabled=False)
-    configure_item("Next waveform", enabled=False)
+    set_enabled(SEND_BUTTONS, False)
     
-    # Run stimulation
-    device.start()
-    time.sleep(dur)
-    device.stop()
-
-    # Reactivate buttons
-    configure_item("Stimulate", enabled=True)
-    configure_item("Send", enabled=True)
-    configure_item("End session", enabled=True)
-    configure_item("Next waveform", enabled=True)
+    # Run stimulation off GUI thread
+    Thread(target=run_stimulation, args=(dur,), daemon=True).start()
+
+def run_stimulation(dur):
+    '''
+    Runs on stimulation thread
+    Stimulates for duration
+    Reactivates buttons when done
+    '''
+    try:
+        # Run stimulation
+        device.start()
+        time.sleep(dur)
+        device.stop()
+    except Exception:
+        set_value("##OverallStatus", "Stimulation failed")
+        raise
+    finally:
+        # Reactivate buttons
+        set_enabled(SEND_BUTTONS, True)
     
 # Next waveform callback
-def nextWaveform_callback(sender, data):
+def nextWaveform_callback(sender, data, get_value=get_value):
     '''
     Move to next waveform
     Save threshold data
     Update waveform display
     Load next waveform
+
+    get_value bound as default: looked up locally for each result input
     '''
-    # Get threshold data
-    interface.thresholds_perception[interface.waveforms[interface.waveform_id]] = get_value("Perception##input")
-    interface.thresholds_sensory[interface.waveforms[interface.waveform_id]] = get_value("Sensory##input")
-    interface.thresholds_motor[interface.waveforms[interface.waveform_id]] = get_value("Motor##input")
-    interface.thresholds_discomfort[interface.waveforms[interface.waveform_id]] = get_value("Discomfort##input")
-    interface.thresholds_pain[interface.waveforms[interface.waveform_id]] = get_value("Pain##input")
-    
-    interface.pain_scores[interface.waveforms[interface.waveform_id]] = get_value("Pain rating##input")
-    interface.electrode_pain[interface.waveforms[interface.waveform_id]] = get_value("Electrode pain##input")
-    interface.paraesthesia_pain[interface.waveforms[interface.waveform_id]] = get_value("Paraesthesia pain##input")
-    interface.motor_pain[interface.waveforms[interface.waveform_id]] = get_value("Motor pain##input")
+    # Get threshold data for current waveform
+    wf = interface.waveforms[interface.waveform_id]
+    interface.results[wf] = [get_value(item) for item in RESULT_INPUTS]
 
     # Move to next waveform
     interface.waveform_id += 1
@@ -439,21 +441,9 @@ def nextWaveform_callback(sender, data):
     # If end reached: disable buttons and inputs, update status
     if interface.waveform_id >= NUM_WAVEFORMS:
         # Disable inputs
-        configure_item("Amplitude (mA)##input", enabled=False)
-        configure_item("Duration (s)##input", enabled=False)
-        configure_item("Send", enabled=False)
-        configure_item("Stimulate", enabled=False)
+        set_enabled(STIM_CONTROLS, False)
 
-        configure_item("Perception##input", enabled=False)
-        configure_item("Sensory##input", enabled=False)
-        configure_item("Motor##input", enabled=False)
-        configure_item("Discomfort##input", enabled=False)
-        configure_item("Pain##input", enabled=False)
-    
-        configure_item("Pain rating##input", enabled=False)
-        configure_item("Electrode pain##input", enabled=False)
-        configure_item("Paraesthesia pain##input", enabled=False)
-        configure_item("Motor pain##input", enabled=False)
+        set_enabled(RESULT_INPUTS, False)
 
         configure_item("Next waveform", enabled=False)
 
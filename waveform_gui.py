@@ -23,7 +23,10 @@ Need to:
 ## Imports
 import numpy as np
 import time
+import traceback
+from functools import lru_cache
 from threading import Thread
+from queue import Queue
 
 import os.path
 
@@ -36,6 +39,29 @@ import wavewriter
 ''' Declare WaveWriter object '''
 device = wavewriter.WaveWriter()
 
+''' Device worker: runs queued jobs in order, off the GUI thread '''
+device_queue = Queue()
+
+def run_device_queue():
+    for job in iter(device_queue.get, None):
+        # Failed jobs restore their own controls: log + keep worker running
+        try:
+            job()
+        except Exception:
+            traceback.print_exc()
+
+''' Item groups enabled + disabled together '''
+WAVEFORM_INPUTS = ("Waveform##input", "Frequency (Hz)##input",
+                   "Amplitude (mA)##input")
+STIM_BUTTONS = ("Stimulate", "Send", "End session")
+
+def set_enabled(items, enabled):
+    '''
+    Enables or disables each named item
+    '''
+    for item in items:
+        configure_item(item, enabled=enabled)
+
 ''' Define state transition callbacks '''
 ''' Sets behaviour for transitioning between interface states
     Can only move through set states:
@@ -101,9 +127,7 @@ def startSession_callback(sender, data):
     set_value("##OverallStatus", "Session started")
 
     # Enable running experiment
-    configure_item("Waveform##input", enabled=True)
-    configure_item("Frequency (Hz)##input", enabled=True)
-    configure_item("Amplitude (mA)##input", enabled=True)
+    set_enabled(WAVEFORM_INPUTS, True)
     configure_item("Duration (s)##input", enabled=False)
     configure_item("Send", enabled=True, callback=send_waveform_callback)
     configure_item("Stimulate", enabled=False)
@@ -126,12 +150,9 @@ def endSession_callback(sender, data):
     configure_item("Start session", enabled=False)
     configure_item("End session", enabled=False)
 
-    configure_item("Waveform##input", enabled=False)
-    configure_item("Frequency (Hz)##input", enabled=False)
-    configure_item("Amplitude (mA)##input", enabled=False)
+    set_enabled(WAVEFORM_INPUTS, False)
     configure_item("Duration (s)##input", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("Stimulate", enabled=False)
+    set_enabled(STIM_BUTTONS, False)
 
     # Update status
     set_value("##SessionStatus", "Not started")
@@ -140,6 +161,45 @@ def endSession_callback(sender, data):
     configure_item("##DeviceStatus", color=[255,0,0])
     set_value("##OverallStatus", "Ready to connect")
 
+# Waveform labels, indexed by radio button value
+WAVEFORMS = ("Tonic", "Sinusoidal", "Wavelet", "Offset wavelet")
+
+# Generators: (amplitude [mA], frequency [Hz]) -> (v, t)
+WAVEFORM_GENERATORS = {
+    "Tonic": lambda a, f: wavewriter.generate_tonic(
+        a, f,
+        30, # us
+        biphasic = True),
+    "Sinusoidal": lambda a, f: wavewriter.generate_sine(
+        a, f,
+        1), # Cycles
+    "Wavelet": lambda a, f: wavewriter.generate_wavelet(
+        a, f,
+        40, # Hz modulating
+        4000), # Standard deviation
+    "Offset wavelet": lambda a, f: wavewriter.generate_wavelet_modulated(
+        a, f,
+        40, # Hz modulating
+        4000), # Standard deviation
+}
+
+# Generate + convert waveform
+@lru_cache(maxsize=32)
+def build_waveform(waveform, frequency, amplitude):
+    '''
+    Generates named waveform
+    Converts to device format
+    Returns device samples only: times are not sent
+    Cached: repeat sends with same parameters reuse result
+    '''
+    v, t = WAVEFORM_GENERATORS[waveform](amplitude, frequency)
+    v, _ = wavewriter.convert_waveform(v, t)
+
+    # Shared by every send with these parameters: keep unmodified
+    v.setflags(write=False)
+
+    return v
+
 # Stimulate callback
 def send_waveform_callback(sender, data):
     '''
@@ -148,8 +208,7 @@ def send_waveform_callback(sender, data):
     '''
     # Get intended waveform
     waveform_id = get_value("Waveform##input")
-    waveforms = ["Tonic", "Sinusoidal", "Wavelet", "Offset wavelet"]
-    waveform = waveforms[waveform_id]
+    waveform = WAVEFORMS[waveform_id]
     print(waveform)
 
     # Get frequency
@@ -158,49 +217,39 @@ def send_waveform_callback(sender, data):
     # Get amplitude
     amplitude = get_value("Amplitude (mA)##input")
 
+    # Check inputs
+    if frequency <= 0:
+        set_value("##OverallStatus", "Enter frequency")
+        return
+    if amplitude <= 0:
+        set_value("##OverallStatus", "Enter amplitude")
+        return
+
     # Send waveform
     print(f"{waveform}: {frequency}Hz, {amplitude}mA")
     
-    if waveform == 'Tonic':
-        v, t = wavewriter.generate_tonic(
-            amplitude, # mA
-            frequency, # Hz
-            30, # us
-            biphasic = True
-        )
-        
-    elif waveform == 'Sinusoidal':
-        v, t = wavewriter.generate_sine(
-            amplitude, # mA
-            frequency, # Hz
-            1 # Cycles
-        )
-        
-    elif waveform == 'Wavelet':
-        v, t = wavewriter.generate_wavelet(
-            amplitude, # mA
-            frequency, # Hz
-            40, # Hz modulating
-            4000 # Standard deviation
-        )
-        
-    elif waveform == 'Offset wavelet':
-        v, t = wavewriter.generate_wavelet_modulated(
-            amplitude, # mA
-            frequency, # Hz
-            40, # Hz modulating
-            4000, # Standard deviation
-        )
-
-    
     # Deactivate stimulate button (if active)
-    configure_item("Stimulate", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("End session", enabled=False)
+    set_enabled(STIM_BUTTONS, False)
     
-    # Send waveform
-    v, t = wavewriter.convert_waveform(v, t)
-    device.send_waveform(v)
+    # Generate + send on device worker
+    device_queue.put(lambda: send_waveform(waveform, frequency, amplitude))
+
+def send_waveform(waveform, frequency, amplitude):
+    '''
+    Runs on device worker
+    Sends waveform to device
+    Re-enables stimulation controls
+    '''
+    try:
+        # Send waveform
+        v = build_waveform(waveform, frequency, amplitude)
+        device.send_waveform(v)
+    except Exception:
+        # Allow resend or ending session, not stimulating
+        configure_item("Send", enabled=True)
+        configure_item("End session", enabled=True)
+        set_value("##OverallStatus", "Send failed")
+        raise
 
     # Update current waveform display
     set_value("##CurrentWaveform", f"{waveform}")
@@ -209,29 +258,40 @@ def send_waveform_callback(sender, data):
     
     # Activate stimulate button
     configure_item("Duration (s)##input", enabled=True)
-    configure_item("Stimulate", enabled=True)
-    configure_item("Send", enabled=True)
-    configure_item("End session", enabled=True)
+    set_enabled(STIM_BUTTONS, True)
     
 # Run stimulation callback
 def stimulate_callback(sender, data):
     # Get duration
     dur = get_value("Duration (s)##input")
+
+    # Check inputs
+    if dur <= 0:
+        set_value("##OverallStatus", "Enter duration")
+        return
     
     # Deactivate buttons
-    configure_item("Stimulate", enabled=False)
-    configure_item("Send", enabled=False)
-    configure_item("End session", enabled=False)
+    set_enabled(STIM_BUTTONS, False)
     
-    # Run stimulation
-    device.start()
-    time.sleep(dur)
-    device.stop()
+    # Run stimulation on device worker
+    device_queue.put(lambda: run_stimulation(dur))
 
-    # Reactivate buttons
-    configure_item("Stimulate", enabled=True)
-    configure_item("Send", enabled=True)
-    configure_item("End session", enabled=True)
+def run_stimulation(dur):
+    '''
+    Runs on device worker
+    Stimulates for duration
+    Re-enables controls
+    '''
+    try:
+        device.start()
+        time.sleep(dur)
+        device.stop()
+    except Exception:
+        set_value("##OverallStatus", "Stimulation failed")
+        raise
+    finally:
+        # Reactivate buttons
+        set_enabled(STIM_BUTTONS, True)
 
 ''' Define window layout '''
 
@@ -295,7 +355,7 @@ with window("ONI"):
         add_spacing(count=3)
 
         # Add input: waveform
-        add_radio_button("Waveform##input", items=["Tonic", "Sinusoidal", "Wavelet", "Offset wavelet"], enabled=False)
+        add_radio_button("Waveform##input", items=list(WAVEFORMS), enabled=False)
 
         # Add input: frequency
         add_input_int("Frequency (Hz)##input", default_value=0, width=100,
@@ -343,6 +403,10 @@ with window("ONI"):
 
 ''' Start GUI '''
 
+# Start device worker
+deviceThread = Thread(target=run_device_queue, daemon=True)
+deviceThread.start()
+
 # Function to start GUI
 def startGUI():
     # Set main window parameters